@@ -31,6 +31,7 @@ import numpy as np
 
 # translate.read_data(shi_sentence_stream, w2i)
 
+# shi_util.write_data_records()
 shi_generator.train()
 
 # shi_generator.decode()
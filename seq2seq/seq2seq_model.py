@@ -28,6 +28,19 @@ import tensorflow as tf
 from seq2seq import data_utils
 
 
+def _fp32_storage_getter(getter, name, dtype=None, trainable=True, **kwargs):
+    """Custom getter storing trainable fp16 variables in fp32.
+
+    The fp32 variable is cast to the requested dtype where it is used, so the
+    computation runs in fp16 while updates are applied to fp32 master weights.
+    """
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, dtype=storage_dtype, trainable=trainable, **kwargs)
+    if trainable and dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
 class Seq2SeqModel(object):
     """Sequence-to-sequence model with attention and for multiple buckets.
 
@@ -56,7 +69,8 @@ class Seq2SeqModel(object):
                  use_lstm=False,
                  num_samples=512,
                  forward_only=False,
-                 dtype=tf.float32):
+                 dtype=tf.float32,
+                 init_loss_scale=128.0):
         """Create the model.
 
         Args:
@@ -78,14 +92,20 @@ class Seq2SeqModel(object):
           use_lstm: if true, we use LSTM cells instead of GRU cells.
           num_samples: number of samples for sampled softmax.
           forward_only: if set, we do not construct the backward pass in the model.
-          dtype: the data type to use to store internal variables.
+          dtype: the data type to use for the computation; with tf.float16,
+            variables are still stored in fp32 and the loss is scaled.
+          init_loss_scale: initial loss scale for fp16 training; it is halved
+            when gradients overflow and doubled after 2000 finite steps.
         """
         self.source_vocab_size = source_vocab_size
         self.target_vocab_size = target_vocab_size
         self.buckets = buckets
         self.batch_size = batch_size
+        # For fp16 we train in mixed precision: fp32 master weights, fp16 compute.
+        mixed_precision = dtype == tf.float16
+        variable_dtype = tf.float32 if mixed_precision else dtype
         self.learning_rate = tf.Variable(
-            float(learning_rate), trainable=False, dtype=dtype)
+            float(learning_rate), trainable=False, dtype=variable_dtype)
         self.learning_rate_decay_op = self.learning_rate.assign(
             self.learning_rate * learning_rate_decay_factor)
         self.global_step = tf.Variable(0, trainable=False)
@@ -95,10 +115,11 @@ class Seq2SeqModel(object):
         softmax_loss_function = None
         # Sampled softmax only makes sense if we sample less than vocabulary size.
         if num_samples > 0 and num_samples < self.target_vocab_size:
-            w_t = tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=dtype)
-            w = tf.transpose(w_t)
-            b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=dtype)
-            output_projection = (w, b)
+            w_t = tf.get_variable("proj_w", [self.target_vocab_size, size],
+                                  dtype=variable_dtype)
+            w = tf.cast(tf.transpose(w_t), dtype)
+            b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=variable_dtype)
+            output_projection = (w, tf.cast(b, dtype))
 
             def sampled_loss(labels, logits):
                 labels = tf.reshape(labels, [-1, 1])
@@ -132,6 +153,11 @@ class Seq2SeqModel(object):
 
         # The seq2seq function: we use embedding for the input and attention.
         # TODO look into the embedding mechanism
+        # Embeddings and the output projection stay in the float dtype, also for
+        # decoding: at batch size 1 a lookup reads only a row per step, the
+        # embeddings are looked up inside legacy_seq2seq, which also applies
+        # output_projection itself, and TF1 has no int8 matmul, so int8 copies
+        # would only be cast back in full on every run.
         def seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
             return tf.contrib.legacy_seq2seq.embedding_attention_seq2seq(
                 encoder_inputs,
@@ -162,33 +188,64 @@ class Seq2SeqModel(object):
                    for i in xrange(len(self.decoder_inputs) - 1)]
 
         # Training outputs and losses.
-        if forward_only:
-            self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
-                self.encoder_inputs, self.decoder_inputs, targets,
-                self.target_weights, buckets, lambda x, y: seq2seq_f(x, y, True),
-                softmax_loss_function=softmax_loss_function)
-            # If we use output projection, we need to project outputs for decoding.
-            if output_projection is not None:
-                for b in xrange(len(buckets)):
-                    self.outputs[b] = [
-                        tf.matmul(output, output_projection[0]) + output_projection[1]
-                        for output in self.outputs[b]
-                    ]
-        else:
-            self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
-                self.encoder_inputs, self.decoder_inputs, targets,
-                self.target_weights, buckets,
-                lambda x, y: seq2seq_f(x, y, False),
-                softmax_loss_function=softmax_loss_function)
+        custom_getter = _fp32_storage_getter if mixed_precision else None
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+            if forward_only:
+                self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
+                    self.encoder_inputs, self.decoder_inputs, targets,
+                    self.target_weights, buckets, lambda x, y: seq2seq_f(x, y, True),
+                    softmax_loss_function=softmax_loss_function)
+                # If we use output projection, we need to project outputs for decoding.
+                if output_projection is not None:
+                    for b in xrange(len(buckets)):
+                        self.outputs[b] = [
+                            tf.matmul(output, output_projection[0]) + output_projection[1]
+                            for output in self.outputs[b]
+                        ]
+            else:
+                self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
+                    self.encoder_inputs, self.decoder_inputs, targets,
+                    self.target_weights, buckets,
+                    lambda x, y: seq2seq_f(x, y, False),
+                    softmax_loss_function=softmax_loss_function)
+
+        # Greedy output ids, so that evaluation need not fetch all the logits.
+        # Training outputs are not projected yet, so we project them here.
+        self.output_ids = []
+        for b in xrange(len(buckets)):
+            logits = self.outputs[b]
+            if output_projection is not None and not forward_only:
+                logits = [tf.matmul(output, output_projection[0]) + output_projection[1]
+                          for output in logits]
+            self.output_ids.append(
+                tf.argmax(tf.stack(logits), axis=2, output_type=tf.int32))
 
         # Gradients and SGD update operation for training the model.
         params = tf.trainable_variables()
+        # Variables of the fp16 loss scaling, fp32 checkpoints do not have them.
+        self.loss_scale_variables = []
         if not forward_only:
             self.gradient_norms = []
             self.updates = []
             opt = tf.train.GradientDescentOptimizer(self.learning_rate)
+            if mixed_precision:
+                # Scale the loss so small fp16 gradients do not underflow. Steps
+                # with non-finite gradients are skipped and halve the scale.
+                existing_variables = set(tf.global_variables())
+                loss_scale_manager = (
+                    tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                        init_loss_scale, incr_every_n_steps=2000,
+                        decr_every_n_nan_or_inf=1, decr_ratio=0.5))
+                self.loss_scale_variables = [v for v in tf.global_variables()
+                                             if v not in existing_variables]
+                opt = tf.contrib.mixed_precision.LossScaleOptimizer(
+                    opt, loss_scale_manager)
             for b in xrange(len(buckets)):
-                gradients = tf.gradients(self.losses[b], params)
+                if mixed_precision:
+                    gradients = [g for g, _ in opt.compute_gradients(
+                        tf.cast(self.losses[b], tf.float32), params)]
+                else:
+                    gradients = tf.gradients(self.losses[b], params)
                 clipped_gradients, norm = tf.clip_by_global_norm(gradients,
                                                                  max_gradient_norm)
                 self.gradient_norms.append(norm)
@@ -197,8 +254,30 @@ class Seq2SeqModel(object):
 
         self.saver = tf.train.Saver(tf.global_variables())
 
+    def restore(self, session, checkpoint_path):
+        """Restore the model from checkpoint_path.
+
+        The loss scale variables are initialized instead if the checkpoint does
+        not have them, i.e. when fp16 training is started from a fp32 checkpoint.
+
+        Args:
+          session: tensorflow session to use.
+          checkpoint_path: checkpoint to restore the variables from.
+        """
+        saved_names = set(name for name, _ in tf.train.list_variables(checkpoint_path))
+        missing = [v for v in self.loss_scale_variables if v.op.name not in saved_names]
+        if not missing:
+            # Also fails, as it should, if any other variable is missing.
+            self.saver.restore(session, checkpoint_path)
+            return
+        print("Initializing loss scale variables not found in the checkpoint: %s"
+              % ", ".join(v.op.name for v in missing))
+        saver = tf.train.Saver([v for v in tf.global_variables() if v not in missing])
+        saver.restore(session, checkpoint_path)
+        session.run(tf.variables_initializer(missing))
+
     def step(self, session, encoder_inputs, decoder_inputs, target_weights,
-             bucket_id, forward_only):
+             bucket_id, forward_only, output_ids=False):
         """Run a step of the model feeding the given inputs.
 
         Args:
@@ -208,6 +287,8 @@ class Seq2SeqModel(object):
           target_weights: list of numpy float vectors to feed as target weights.
           bucket_id: which bucket of the model to use.
           forward_only: whether to do the backward step or only forward.
+          output_ids: if set, the outputs of a forward step are the greedy output
+            ids, a [decoder_size, batch_size] int matrix, instead of the logits.
 
         Returns:
           A triple consisting of gradient norm (or None if we did not do backward),
@@ -248,12 +329,17 @@ class Seq2SeqModel(object):
                            self.losses[bucket_id]]  # Loss for this batch.
         else:
             output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-            for l in xrange(decoder_size):  # Output logits.
-                output_feed.append(self.outputs[bucket_id][l])
+            if output_ids:
+                output_feed.append(self.output_ids[bucket_id])  # Output ids.
+            else:
+                for l in xrange(decoder_size):  # Output logits.
+                    output_feed.append(self.outputs[bucket_id][l])
 
         outputs = session.run(output_feed, input_feed)
         if not forward_only:
             return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+        elif output_ids:
+            return None, outputs[0], outputs[1]  # No gradient norm, loss, output ids.
         else:
             return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
 
@@ -379,3 +465,61 @@ class Seq2SeqModel(object):
                     batch_weight[batch_idx] = 0.0
             batch_weights.append(batch_weight)
         return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+
+    def pad_data(self, data):
+        """Pad all cases of data to their buckets once, for get_padded_batch(...).
+
+        Args:
+          data: a tuple of size len(self.buckets) in which each element contains
+            lists of pairs of input and output data, as for get_batch(...).
+
+        Returns:
+          A list with, for each bucket, the triple (encoder_inputs, decoder_inputs,
+          target_weights) of length-major matrices that hold the prepared cases of
+          the bucket as columns.
+        """
+        padded_data = []
+        for bucket_id, (encoder_size, decoder_size) in enumerate(self.buckets):
+            cases = data[bucket_id]
+            encoder_inputs = np.full((encoder_size, len(cases)), data_utils.PAD_ID,
+                                     dtype=np.int32)
+            decoder_inputs = np.full((decoder_size, len(cases)), data_utils.PAD_ID,
+                                     dtype=np.int32)
+            decoder_inputs[0] = data_utils.GO_ID
+            for case_idx, (encoder_input, decoder_input) in enumerate(cases):
+                # Encoder inputs are padded and then reversed.
+                encoder_inputs[encoder_size - len(encoder_input):, case_idx] = (
+                    encoder_input[::-1])
+                # Decoder inputs get an extra "GO" symbol, and are padded then.
+                decoder_inputs[1:len(decoder_input) + 1, case_idx] = decoder_input
+
+            # Weights are 0 for targets (decoder inputs shifted by 1) that are PAD.
+            target_weights = np.zeros((decoder_size, len(cases)), dtype=np.float32)
+            target_weights[:-1] = decoder_inputs[1:] != data_utils.PAD_ID
+            padded_data.append((encoder_inputs, decoder_inputs, target_weights))
+        return padded_data
+
+    def get_padded_batch(self, padded_data, bucket_id, out=None):
+        """Get a random batch from data prepared by pad_data(...).
+
+        Same as get_batch(...), but the cases are already padded, so building
+        the batch is just a gather of random columns.
+
+        Args:
+          padded_data: the result of pad_data(...).
+          bucket_id: integer, which bucket to get the batch for.
+          out: optional triple of preallocated matrices to gather the batch into.
+
+        Returns:
+          The triple (encoder_inputs, decoder_inputs, target_weights) of
+          length-major matrices, each row of which is fed as in step(...).
+        """
+        encoder_inputs, _, _ = padded_data[bucket_id]
+        case_idxs = np.random.randint(encoder_inputs.shape[1], size=self.batch_size)
+        if out is None:
+            return tuple(inputs.take(case_idxs, axis=1) for inputs in padded_data[bucket_id])
+        for inputs, batch_inputs in zip(padded_data[bucket_id], out):
+            # The indices are in range; with the default mode="raise", numpy would
+            # gather into a temporary buffer and copy that into out.
+            inputs.take(case_idxs, axis=1, out=batch_inputs, mode="clip")
+        return out
@@ -34,11 +34,14 @@ from __future__ import print_function
 import logging
 import math
 import os
+import random
 import sys
+import threading
 import time
 
 import numpy as np
 import tensorflow as tf
+from six.moves import queue
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from seq2seq import data_utils
@@ -66,6 +69,11 @@ tf.app.flags.DEFINE_boolean("self_test", False,
                             "Run a self-test if this is set to True.")
 tf.app.flags.DEFINE_boolean("use_fp16", False,
                             "Train using fp16 instead of fp32.")
+tf.app.flags.DEFINE_float("loss_scale", 128.0,
+                          "Initial loss scale for fp16 training.")
+tf.app.flags.DEFINE_boolean("use_data_pipeline", True,
+                            "Feed training batches from a tf.data pipeline "
+                            "instead of prefetching model.pad_data batches in a thread.")
 
 # ./tem512 is for size 512 check potins, ./tmp256 is for 256 size
 tf.app.flags.DEFINE_string("train_dir", "./tmp256", "Training directory.")
@@ -85,12 +93,152 @@ FLAGS = tf.app.flags.FLAGS
 
 # We use a number of buckets and pad to the closest one for efficiency.
 # See seq2seq_model.Seq2SeqModel for details of how they work.
-_buckets = [(5, 6), (6, 7), (8, 9), (15, 16)]
+_buckets = [(5, 6), (6, 7), (8, 9), (10, 11), (12, 13), (15, 16)]
 buckets = _buckets
 
 _show_example_num = 5
 
 
+def _cut_positions(ids, stop_ids=(data_utils.EOS_ID,)):
+    """Index of the first stop symbol in each row of ids, or the row length."""
+    stops = np.isin(ids, stop_ids)
+    return np.where(stops.any(axis=1), stops.argmax(axis=1), ids.shape[1])
+
+
+def _i2w_array(i2w):
+    """Turn the i2w mapping into an object array, to look up many ids at once."""
+    ids = [i for i in i2w if isinstance(i, int)]
+    i2w_arr = np.array([tf.compat.as_str(w) for w in data_utils._START_VOCAB] +
+                       [""] * (max(ids) + 1 - len(data_utils._START_VOCAB)), dtype=object)
+    for i in ids:
+        i2w_arr[i] = tf.compat.as_str(i2w[i])
+    return i2w_arr
+
+
+class AsyncCheckpointSaver(object):
+    """Save checkpoints from a background thread.
+
+    The variables are first copied into shadow variables on the CPU, which is
+    fast, and a daemon thread then writes the shadow copies to disk while
+    training goes on. Checkpoints use the original variable names, so they can
+    be restored with model.saver. At most one save is in flight at a time.
+    """
+
+    def __init__(self, session, var_list):
+        self._session = session
+        with tf.name_scope("async_checkpoint"), tf.device("/cpu:0"):
+            shadows = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                                   trainable=False, collections=[])
+                       for v in var_list]
+        self._copy_op = tf.group(*[tf.assign(s, v) for s, v in zip(shadows, var_list)])
+        self._saver = tf.train.Saver({v.op.name: s for v, s in zip(var_list, shadows)})
+        session.run([s.initializer for s in shadows])
+
+        self._in_flight = threading.Semaphore(1)
+        self._requests = queue.Queue()
+        self._error = None
+        thread = threading.Thread(target=self._write_checkpoints)
+        thread.daemon = True
+        thread.start()
+
+    def save(self, save_path, global_step):
+        """Snapshot the variables now and write them to save_path in background.
+
+        Raises:
+          Exception: the error of a previous save that failed.
+        """
+        # Wait for the previous save, its shadow copies must not be overwritten.
+        self._in_flight.acquire()
+        if self._error is not None:
+            self._in_flight.release()
+            raise self._error
+        self._session.run(self._copy_op)
+        self._requests.put((save_path, global_step))
+
+    def close(self):
+        """Wait until the checkpoint being written, if any, is complete.
+
+        Raises:
+          Exception: the error of a save that failed.
+        """
+        self._in_flight.acquire()
+        self._in_flight.release()
+        if self._error is not None:
+            raise self._error
+
+    def _write_checkpoints(self):
+        while True:
+            save_path, global_step = self._requests.get()
+            try:
+                self._saver.save(self._session, save_path, global_step=global_step)
+            except Exception as e:  # pylint: disable=broad-except
+                # Kept for the training loop, which stops on the next save.
+                self._error = e
+            finally:
+                self._in_flight.release()
+
+
+class BatchPrefetcher(object):
+    """Prepare training batches from pad_data(...) output in a background thread.
+
+    Batches are gathered into preallocated buffers, num_slots per bucket, so
+    no arrays are allocated per step. Buckets are picked at random according
+    to buckets_scale, as in the training loop.
+    """
+
+    def __init__(self, model, padded_data, buckets_scale, num_slots=4):
+        self._model = model
+        self._padded_data = padded_data
+        self._buckets_scale = buckets_scale
+        self._buffers = [[tuple(np.empty((inputs.shape[0], model.batch_size), dtype=inputs.dtype)
+                                for inputs in bucket_data)
+                          for _ in xrange(num_slots)]
+                         for bucket_data in padded_data]
+        self._free_slots = [queue.Queue() for _ in padded_data]
+        for free_slots in self._free_slots:
+            for slot in xrange(num_slots):
+                free_slots.put(slot)
+        self._ready = queue.Queue(maxsize=num_slots)
+        self._in_use = None
+
+        thread = threading.Thread(target=self._fill_slots)
+        thread.daemon = True
+        thread.start()
+
+    def get(self):
+        """Return the next (bucket_id, batch); the batch is valid until the next call.
+
+        Raises:
+          Exception: whatever stopped the background thread from preparing batches.
+        """
+        if self._in_use is not None:
+            bucket_id, slot = self._in_use
+            self._free_slots[bucket_id].put(slot)
+            self._in_use = None
+        ready = self._ready.get()
+        if isinstance(ready, Exception):
+            # Leave it for further calls too, the thread has stopped.
+            self._ready.put(ready)
+            raise ready
+        self._in_use = bucket_id, slot = ready
+        return bucket_id, self._buffers[bucket_id][slot]
+
+    def _fill_slots(self):
+        try:
+            while True:
+                # Choose a bucket according to data distribution. We pick a random number
+                # in [0, 1] and use the corresponding interval in buckets_scale.
+                bucket_id = int(np.searchsorted(self._buckets_scale,
+                                                np.random.random_sample(), side='right'))
+                slot = self._free_slots[bucket_id].get()
+                self._model.get_padded_batch(self._padded_data, bucket_id,
+                                             out=self._buffers[bucket_id][slot])
+                self._ready.put((bucket_id, slot))
+        except Exception as e:  # pylint: disable=broad-except
+            # Hand the error to the training loop instead of leaving it waiting.
+            self._ready.put(e)
+
+
 def create_model(session, forward_only):
     """Create translation model and initialize or load parameters in session."""
     dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
@@ -105,17 +253,97 @@ def create_model(session, forward_only):
         FLAGS.learning_rate,
         FLAGS.learning_rate_decay_factor,
         forward_only=forward_only,
-        dtype=dtype)
+        dtype=dtype,
+        init_loss_scale=FLAGS.loss_scale)
     ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir,)
     if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
         print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+        model.restore(session, ckpt.model_checkpoint_path)
     else:
         print("Created model with fresh parameters.")
         session.run(tf.global_variables_initializer())
     return model
 
 
+def create_train_dataset(dtype=tf.float32):
+    """Build a tf.data pipeline producing padded training batches.
+
+    Batch assembly, padding and bucket sampling run inside tf.data, so the
+    training loop only has to fetch the next batch. Batches come out of the
+    buckets as they fill up, i.e. proportionally to the bucket sizes.
+
+    The training data is streamed from the TFRecord files written by
+    shi_util.write_data_records() when they are up to date, and taken from
+    shi_util.read_data() otherwise.
+
+    Args:
+      dtype: the data type of the target weights.
+
+    Returns:
+      A dataset of (bucket_id, encoder_inputs, decoder_inputs, target_weights)
+      batches; the inputs are length-major, as expected by model.step(...).
+    """
+    if shi_util.has_data_records():
+        print("Streaming training data from TFRecord files.")
+        dataset = shi_util.read_data_records()
+    else:
+        train_set = shi_util.read_data(is_dev_set=False)
+
+        def generator():
+            # read_data groups the pairs by bucket; shuffle them all (anew for
+            # every epoch), the shuffle buffer below is much smaller than the data.
+            pairs = [pair for bucket in train_set for pair in bucket]
+            random.shuffle(pairs)
+            for source, target in pairs:
+                yield source, target
+
+        dataset = tf.data.Dataset.from_generator(
+            generator, (tf.int32, tf.int32),
+            (tf.TensorShape([None]), tf.TensorShape([None])))
+
+    encoder_sizes = tf.constant([b[0] for b in _buckets], dtype=tf.int32)
+    decoder_sizes = tf.constant([b[1] for b in _buckets], dtype=tf.int32)
+
+    def fits_buckets(source, target):
+        return tf.logical_and(tf.size(source) < encoder_sizes,
+                              tf.size(target) < decoder_sizes)
+
+    def pad_to_bucket(source, target):
+        # Use the first bucket the pair fits into, as read_data does.
+        bucket_id = tf.argmax(tf.cast(fits_buckets(source, target), tf.int32),
+                              output_type=tf.int32)
+        # Encoder inputs are padded and then reversed.
+        encoder_pad = encoder_sizes[bucket_id] - tf.size(source)
+        encoder_input = tf.reverse(
+            tf.pad(source, [[0, encoder_pad]], constant_values=data_utils.PAD_ID), [0])
+        # Decoder inputs get an extra "GO" symbol, and are padded then.
+        decoder_pad = decoder_sizes[bucket_id] - tf.size(target) - 1
+        decoder_input = tf.pad(tf.concat([[data_utils.GO_ID], target], 0),
+                               [[0, decoder_pad]], constant_values=data_utils.PAD_ID)
+        # Weights are 0 for targets (decoder inputs shifted by 1) that are padding.
+        targets = tf.concat([decoder_input[1:], [data_utils.PAD_ID]], 0)
+        weights = tf.cast(tf.not_equal(targets, data_utils.PAD_ID), dtype)
+        return bucket_id, encoder_input, decoder_input, weights
+
+    def to_length_major(bucket_ids, encoder_inputs, decoder_inputs, weights):
+        return (bucket_ids[0], tf.transpose(encoder_inputs),
+                tf.transpose(decoder_inputs), tf.transpose(weights))
+
+    # Padded encoder inputs have the length of their bucket, so every bucket
+    # gets a boundary of its own.
+    bucketing = tf.data.experimental.bucket_by_sequence_length(
+        element_length_fn=lambda bucket_id, encoder_input, *_: tf.size(encoder_input),
+        bucket_boundaries=[b[0] + 1 for b in _buckets],
+        bucket_batch_sizes=[FLAGS.batch_size] * (len(_buckets) + 1))
+
+    return (dataset.filter(lambda source, target: tf.reduce_any(fits_buckets(source, target)))
+            .shuffle(10000).repeat()
+            .map(pad_to_bucket, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            .apply(bucketing)
+            .map(to_length_major)
+            .prefetch(tf.data.experimental.AUTOTUNE))
+
+
 def train():
     """Train a shi generator model."""
 
@@ -126,110 +354,139 @@ def train():
 
         # Read data into buckets and compute their sizes.
         print("Reading development and training data.")
-        dev_set = shi_util.read_data(is_dev_set=True)
-        train_set = shi_util.read_data(is_dev_set=False)
-
-        train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
-        train_total_size = float(sum(train_bucket_sizes))
-
-        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
-        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                               for i in xrange(len(train_bucket_sizes))]
-
-        # This is the training loop.
-        step_time, loss = 0.0, 0.0
+        # With up-to-date TFRecords, training streams them and data_set.dat,
+        # which holds the whole corpus, is not opened at all.
+        if FLAGS.use_data_pipeline and shi_util.has_data_records():
+            dev_set = shi_util.read_dev_data_records()
+        else:
+            dev_set = shi_util.read_data(is_dev_set=True)
+
+        if FLAGS.use_data_pipeline:
+            dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
+            next_batch = create_train_dataset(dtype).make_one_shot_iterator().get_next()
+        else:
+            train_set = shi_util.read_data(is_dev_set=False)
+            train_bucket_sizes = np.fromiter(
+                (len(train_set[b]) for b in xrange(len(_buckets))), dtype=np.int64)
+
+            # A bucket scale is a float64 array of increasing numbers up to 1, the
+            # cumulative fractions of the bucket sizes, that we'll use to select a
+            # bucket. Length of [scale[i], scale[i+1]] is proportional to the size
+            # of the i+1-th training bucket, as used later.
+            train_buckets_scale_np = np.cumsum(train_bucket_sizes) / train_bucket_sizes.sum()
+            batch_prefetcher = BatchPrefetcher(model, model.pad_data(train_set),
+                                               train_buckets_scale_np)
+
+        # This is the training loop; step time is counted in nanoseconds.
+        step_time, loss = 0, 0.0
         current_step = 0
         previous_losses = []
 
+        checkpoint_saver = AsyncCheckpointSaver(sess, tf.global_variables())
+        checkpoint_path = os.path.join(FLAGS.train_dir, "shi_rnn.ckp")
+
         (w2i, i2w) = shi_util.load_shi_vocab_mapping()
-        while True:
-            # Choose a bucket according to data distribution. We pick a random number
-            # in [0, 1] and use the corresponding interval in train_buckets_scale.
-            random_number_01 = np.random.random_sample()
-            bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                             if train_buckets_scale[i] > random_number_01])
-
-            # Get a batch and make a step.
-            start_time = time.time()
-            encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                train_set, bucket_id)
-            _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                         target_weights, bucket_id, False)
-            step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
-            loss += step_loss / FLAGS.steps_per_checkpoint
-            current_step += 1
-
-            # Once in a while, we save checkpoint, print statistics, and run evals.
-            if current_step % FLAGS.steps_per_checkpoint == 0:
-                # Print statistics for the previous epoch.
-                perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-                print("global step %d learning rate %.4f step-time %.2f perplexity "
-                      "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                                step_time, perplexity))
-                # Decrease learning rate if no improvement was seen over last 3 times.
-                if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-                    sess.run(model.learning_rate_decay_op)
-                previous_losses.append(loss)
-                # Save checkpoint and zero timer and loss.
-                checkpoint_path = os.path.join(FLAGS.train_dir, "shi_rnn.ckp")
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                step_time, loss = 0.0, 0.0
-                # Run evals on development set and print their perplexity.
-                for bucket_id in xrange(len(_buckets)):
-                    if len(dev_set[bucket_id]) == 0:
-                        print("  eval: empty bucket %d" % (bucket_id))
-                        continue
-                    encoder_inputs, decoder_inputs, target_weights, source, target = model.get_dev_batch(
-                        dev_set, bucket_id)
-                    _, eval_loss, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                                 target_weights, bucket_id, True)
-                    eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-                        "inf")
-                    print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
-
-                    # TODO
-                    # to randomly print out some resulting sentences
-                    outputs = np.argmax(output_logits, axis=2).transpose()
-
-                    # randomly select some examples
-                    for i in xrange(_show_example_num):
-                        index_to_show = randint(0, FLAGS.batch_size-1)
-                        ori_text = source[index_to_show]
-                        target_text = target[index_to_show]
-                        out_text = outputs[index_to_show]
-
-                        # If there is an EOS symbol in outputs, cut them at that point.
-                        if data_utils.EOS_ID in ori_text:
-                            ori_text = ori_text[:ori_text.index(data_utils.EOS_ID)]
-                        # Print out French sentence corresponding to outputs.
-                        print("Original / generated / target text: ")
-                        print(" ".join([tf.compat.as_str(i2w[output]) for output in ori_text]))
-
-                        # If there is an EOS symbol in outputs, cut them at that point.
-                        if data_utils.EOS_ID in out_text:
-                            out_text = out_text[:out_text.index(data_utils.EOS_ID)]
-                        # Print out French sentence corresponding to outputs.
-                        print(" ".join([tf.compat.as_str(i2w[output]) for output in out_text]))
-
-                        # If there is an EOS symbol in outputs, cut them at that point.
-                        if data_utils.EOS_ID in target_text:
-                            target_text = target_text[:target_text.index(data_utils.EOS_ID)]
-                        # Print out French sentence corresponding to outputs.
-                        print(" ".join([tf.compat.as_str(i2w[output]) for output in target_text]))
-
-                sys.stdout.flush()
+        i2w_arr = _i2w_array(i2w)
+        try:
+            while True:
+                # Get a batch and make a step.
+                start_time = time.perf_counter_ns()
+                if FLAGS.use_data_pipeline:
+                    bucket_id, encoder_inputs, decoder_inputs, target_weights = sess.run(
+                        next_batch)
+                else:
+                    bucket_id, (encoder_inputs, decoder_inputs, target_weights) = (
+                        batch_prefetcher.get())
+                _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                             target_weights, bucket_id, False)
+                step_time += time.perf_counter_ns() - start_time
+                loss += step_loss / FLAGS.steps_per_checkpoint
+                current_step += 1
+
+                # Once in a while, we save checkpoint, print statistics, and run evals.
+                if current_step % FLAGS.steps_per_checkpoint == 0:
+                    # Print statistics for the previous epoch.
+                    perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+                    global_step, learning_rate = sess.run([model.global_step, model.learning_rate])
+                    print("global step %d learning rate %.4f step-time %.2f perplexity "
+                          "%.2f" % (global_step, learning_rate,
+                                    step_time / (FLAGS.steps_per_checkpoint * 1e9), perplexity))
+                    # Decrease learning rate if no improvement was seen over last 3 times.
+                    if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+                        sess.run(model.learning_rate_decay_op)
+                    previous_losses.append(loss)
+                    # Save checkpoint and zero timer and loss.
+                    checkpoint_saver.save(checkpoint_path, global_step)
+                    step_time, loss = 0, 0.0
+                    # Run evals on development set and print their perplexity.
+                    for bucket_id in xrange(len(_buckets)):
+                        if len(dev_set[bucket_id]) == 0:
+                            print("  eval: empty bucket %d" % (bucket_id))
+                            continue
+                        encoder_inputs, decoder_inputs, target_weights, _, _ = model.get_dev_batch(
+                            dev_set, bucket_id)
+                        _, eval_loss, output_ids = model.step(sess, encoder_inputs, decoder_inputs,
+                                                  target_weights, bucket_id, True,
+                                                  output_ids=True)
+                        eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
+                            "inf")
+                        print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+
+                        # TODO
+                        # to randomly print out some resulting sentences
+                        outputs = output_ids.transpose()
+                        # Batch-major source (un-reversed) and target (without GO).
+                        source = np.stack(encoder_inputs, axis=1)[:, ::-1]
+                        target = np.stack(decoder_inputs, axis=1)[:, 1:]
+
+                        # If there is an EOS symbol in a sentence, cut it at that point;
+                        # the source is also cut where its padding starts.
+                        source_len = _cut_positions(source, (data_utils.EOS_ID, data_utils.PAD_ID))
+                        output_len = _cut_positions(outputs)
+                        target_len = _cut_positions(target)
+
+                        # randomly select some examples
+                        for i in xrange(_show_example_num):
+                            index_to_show = randint(0, FLAGS.batch_size-1)
+                            ori_text = source[index_to_show, :source_len[index_to_show]]
+                            out_text = outputs[index_to_show, :output_len[index_to_show]]
+                            target_text = target[index_to_show, :target_len[index_to_show]]
+
+                            # Print out French sentence corresponding to outputs.
+                            print("Original / generated / target text: ")
+                            print(" ".join(i2w_arr[ori_text].tolist()))
+                            print(" ".join(i2w_arr[out_text].tolist()))
+                            print(" ".join(i2w_arr[target_text].tolist()))
+
+                    sys.stdout.flush()
+        finally:
+            # Do not let the session close under a checkpoint being written.
+            checkpoint_saver.close()
 
 
 def decode():
-    with tf.Session() as sess:
+    # Let XLA compile the graph where it can, e.g. to fuse the RNN cell ops.
+    config = tf.ConfigProto()
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    with tf.Session(config=config) as sess:
         # Create model and load parameters.
         model = create_model(sess, True)
         model.batch_size = 1  # We decode one sentence at a time.
 
+        # Run every bucket once on a dummy sentence, so that the one-off setup
+        # of each bucket graph does not slow down the first real sentences.
+        for bucket_id, (encoder_size, decoder_size) in enumerate(_buckets):
+            model.step(sess,
+                       [np.zeros([1], dtype=np.int32)] * encoder_size,
+                       [np.zeros([1], dtype=np.int32)] * decoder_size,
+                       [np.zeros([1], dtype=np.float32)] * decoder_size,
+                       bucket_id, True, output_ids=True)
+        # Decoding only runs the graph, make sure nothing is added to it.
+        sess.graph.finalize()
+
         # Load vocabularies.
         (w2i, i2w) = shi_util.load_shi_vocab_mapping()
+        i2w_arr = _i2w_array(i2w)
 
         # Decode from standard input.
         sys.stdout.write("> ")
@@ -251,19 +508,21 @@ def decode():
             # Get a 1-element batch to feed the sentence to the model.
             encoder_inputs, decoder_inputs, target_weights, source, target = model.get_dev_batch(
                 {bucket_id: [(token_ids, [])]}, bucket_id)
-            # Get output logits for the sentence.
-            _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                             target_weights, bucket_id, True)
-            # This is a greedy decoder - outputs are just argmaxes of output_logits.
+            # Get output ids for the sentence.
+            # This is a greedy decoder - outputs are just argmaxes of output_logits,
+            # computed in the graph.
             # TODO implement a beam search
             # TODO is the output mapping correct? considering vocab starting from 4
-            outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
+            _, _, output_ids = model.step(sess, encoder_inputs, decoder_inputs,
+                                          target_weights, bucket_id, True,
+                                          output_ids=True)
+            outputs = output_ids[:, 0].tolist()
 
             # If there is an EOS symbol in outputs, cut them at that point.
             if data_utils.EOS_ID in outputs:
                 outputs = outputs[:outputs.index(data_utils.EOS_ID)]
             # Print out French sentence corresponding to outputs.
-            print(" ".join([tf.compat.as_str(i2w[output]) for output in outputs]))
+            print(" ".join(i2w_arr[np.asarray(outputs, dtype=np.int64)].tolist()))
             print("> ", end="")
             sys.stdout.flush()
 
@@ -1,9 +1,13 @@
+import os
 import sys
 
+import tensorflow as tf
+
 from seq2seq import shi_generator
 from shi_gen_util import read_shi
 import pickle
 import operator
+import random
 from random import randint
 
 _PAD = b"_PAD"
@@ -20,6 +24,12 @@ UNK_ID = 3
 _dev_data_ratio = 0.01
 _buckets = shi_generator.buckets
 
+_data_records_num_shards = 10
+_data_records_pattern = './shi_gen_data/train-*.tfrecord'
+_data_records_shard_path = './shi_gen_data/train-%02d-of-%02d.tfrecord'
+# the dev pairs are small, they are kept in a pickle of their own
+_data_records_dev_path = './shi_gen_data/dev_pairs.dat'
+
 
 
 
@@ -157,27 +167,103 @@ def load_data(max_size=None):
     return [data_set, data_set_dev]
 
 
-def read_data(is_dev_set=False, max_size=None):
+def load_data_set(max_size=None):
+    """load [data_set, data_set_dev, buckets] from file, or create new"""
     try:
         with open('./shi_gen_data/data_set.dat', 'rb') as f:
             # load the object from the file into var b
             print('Loading data set from file: ./shi_gen_data/data_set.dat')
             data = pickle.load(f)
             f.close()
-            if is_dev_set:
-                return data[1]
-            return data[0]
 
     except FileNotFoundError:
+        data = None
+
+    # the cached data set is only valid for the buckets it was built with
+    if data is None or len(data) < 3 or data[2] != _buckets:
         print('Building new data set  data ...')
 
-        data = load_data(max_size)
+        data = load_data(max_size) + [_buckets]
 
         with open('./shi_gen_data/data_set.dat', 'wb') as f:
             pickle.dump(data, f)
             f.close()
 
-            if is_dev_set:
-                return data[1]
-            return data[0]
+    return data
 
+
+def read_data(is_dev_set=False, max_size=None):
+    data = load_data_set(max_size)
+    if is_dev_set:
+        return data[1]
+    return data[0]
+
+
+def write_data_records():
+    """write the training data set into shuffled TFRecord shards, for read_data_records,
+    and the dev data set into its own file, for read_dev_data_records"""
+    data = load_data_set()
+    pairs = [pair for bucket in data[0] for pair in bucket]
+    # shuffle first, so that every shard has the same mix of sentence lengths
+    random.shuffle(pairs)
+
+    writers = [tf.python_io.TFRecordWriter(
+        _data_records_shard_path % (i, _data_records_num_shards))
+        for i in range(_data_records_num_shards)]
+    for i, (source_ids, target_ids) in enumerate(pairs):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'source': tf.train.Feature(int64_list=tf.train.Int64List(value=source_ids)),
+            'target': tf.train.Feature(int64_list=tf.train.Int64List(value=target_ids)),
+        }))
+        writers[i % _data_records_num_shards].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+    print('Wrote %d training pairs to %s' % (len(pairs), _data_records_pattern))
+
+    # written last, so that it marks the records as complete
+    dev_pairs = [pair for bucket in data[1] for pair in bucket]
+    with open(_data_records_dev_path, 'wb') as f:
+        pickle.dump(dev_pairs, f)
+        f.close()
+    print('Wrote %d dev pairs to %s' % (len(dev_pairs), _data_records_dev_path))
+
+
+def has_data_records():
+    """check if complete records exist, written with the current w2i mapping"""
+    files = [_data_records_shard_path % (i, _data_records_num_shards)
+             for i in range(_data_records_num_shards)] + [_data_records_dev_path]
+    if not all(os.path.exists(f) for f in files) or not os.path.exists('./shi_gen_data/w2i.dat'):
+        return False
+    # the records hold token ids, a rebuilt mapping makes them stale
+    return os.path.getmtime(_data_records_dev_path) >= os.path.getmtime('./shi_gen_data/w2i.dat')
+
+
+def read_dev_data_records():
+    """load the dev pairs written by write_data_records and put them into buckets"""
+    with open(_data_records_dev_path, 'rb') as f:
+        dev_pairs = pickle.load(f)
+        f.close()
+
+    data_set_dev = [[] for _ in _buckets]
+    for source_ids, target_ids in dev_pairs:
+        for bucket_id, (source_size, target_size) in enumerate(_buckets):
+            if len(source_ids) < source_size and len(target_ids) < target_size:
+                data_set_dev[bucket_id].append([source_ids, target_ids])
+                break
+    return data_set_dev
+
+
+def read_data_records():
+    """stream (source, target) pairs from the TFRecord files, reading shards in parallel"""
+    def parse(record):
+        features = tf.parse_single_example(record, {
+            'source': tf.VarLenFeature(tf.int64),
+            'target': tf.VarLenFeature(tf.int64),
+        })
+        return (tf.cast(tf.sparse_tensor_to_dense(features['source']), tf.int32),
+                tf.cast(tf.sparse_tensor_to_dense(features['target']), tf.int32))
+
+    return (tf.data.Dataset.list_files(_data_records_pattern)
+            .interleave(tf.data.TFRecordDataset, cycle_length=8,
+                        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            .map(parse, num_parallel_calls=tf.data.experimental.AUTOTUNE))